@@ -0,0 +1,40 @@
+#    kugupu - molecular networks for change transport
+#    Copyright (C) 2019  Micaela Matta and Richard J Gowers
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Ahead of time compilation of the numba kernels
+
+Only used by setup.py, which builds kugupu._kugupu_kernels from this so
+that workers don't pay the jit compilation cost.  The kernel source is
+loaded straight from kugupu/_kernels.py, as the package itself can't be
+imported before it is built.
+
+"""
+import importlib.util
+import os
+
+from numba.pycc import CC
+
+_spec = importlib.util.spec_from_file_location(
+    '_kernels', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'kugupu', '_kernels.py'))
+_kernels = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(_kernels)
+
+cc = CC('_kugupu_kernels')
+
+cc.export('coupling_block',
+          'void(f8[:, :], f8[:, :], f8[:, :], f8[:, :], i8, i8)')(_kernels._coupling_block)
+cc.export('unwrap_fragments',
+          'void(f4[:, :], i8[:], i8[:], i8[:], f4[:])')(_kernels._unwrap_fragments)
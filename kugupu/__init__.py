@@ -30,7 +30,8 @@ def disable_debug_logging():
 disable_debug_logging()
 
 
-from .results_io import KugupuResults, save_results, load_results
+from .results_io import (KugupuResults, BackedKugupuResults,
+                         save_results, load_results)
 from . import time
 from . import dimers
 from . import _yaehmop
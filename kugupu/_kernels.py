@@ -0,0 +1,130 @@
+#    kugupu - molecular networks for change transport
+#    Copyright (C) 2019  Micaela Matta and Richard J Gowers
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Numba compiled kernels for the per frame hot loops
+
+The kernels are written as plain Python functions, then either taken
+from the ahead of time compiled _kugupu_kernels module (see
+devtools/aot_kernels.py) or, if that wasn't built, jit compiled on first use.
+
+"""
+import numpy as np
+from numba import njit
+
+
+def _coupling_block(H_frag, psi_i, Hij, psi_j, ix, jx):
+    """Fill the coupling between two fragments into H_frag
+
+    Calculates abs(<psi_i|Hij|psi_j>) and writes it into both the
+    (i, j) block and, transposed, the (j, i) block of H_frag
+
+    Parameters
+    ----------
+    H_frag : numpy array
+      coupling matrix, modified in place
+    psi_i, psi_j : numpy array
+      wavefunctions of each fragment, shape (norbitals, degeneracy)
+    Hij : numpy array
+      off diagonal Hamiltonian between the two fragments
+    ix, jx : int
+      start index of each fragment in H_frag
+    """
+    n_i, deg_i = psi_i.shape
+    n_j, deg_j = psi_j.shape
+
+    # as in np.linalg.multi_dot, contract Hij with whichever
+    # wavefunction gives the fewest operations first
+    if deg_j <= deg_i:
+        acc = np.zeros(deg_i)
+        for b in range(deg_j):
+            acc[:] = 0.0
+            for k in range(n_i):
+                # (Hij . psi_j)[k, b], the intermediate is never stored
+                t = 0.0
+                for l in range(n_j):
+                    t += Hij[k, l] * psi_j[l, b]
+                for a in range(deg_i):
+                    acc[a] += psi_i[k, a] * t
+            for a in range(deg_i):
+                s = abs(acc[a])
+                H_frag[ix + a, jx + b] = s
+                H_frag[jx + b, ix + a] = s
+    else:
+        acc = np.zeros(deg_j)
+        for a in range(deg_i):
+            acc[:] = 0.0
+            for l in range(n_j):
+                # (psi_i.T . Hij)[a, l], the intermediate is never stored
+                t = 0.0
+                for k in range(n_i):
+                    t += psi_i[k, a] * Hij[k, l]
+                for b in range(deg_j):
+                    acc[b] += t * psi_j[l, b]
+            for b in range(deg_j):
+                s = abs(acc[b])
+                H_frag[ix + a, jx + b] = s
+                H_frag[jx + b, ix + a] = s
+
+
+def _unwrap_fragments(pos, frag_ptr, bond_ptr, bond_idx, box):
+    """Make all fragments whole across periodic boundaries
+
+    Each fragment is walked breadth first from its first atom along
+    its bonds, placing every atom in the closest image to the atom
+    it was reached from.  This runs serially, as it is called from
+    frames already being processed in parallel by dask or multiprocessing.
+
+    Parameters
+    ----------
+    pos : numpy array
+      positions of all atoms, ordered by fragment, modified in place
+    frag_ptr : numpy array
+      fragment f owns atoms frag_ptr[f]:frag_ptr[f+1]
+    bond_ptr, bond_idx : numpy array
+      atom a is bonded to atoms bond_idx[bond_ptr[a]:bond_ptr[a+1]]
+    box : numpy array
+      orthorhombic box lengths
+    """
+    for f in range(frag_ptr.shape[0] - 1):
+        start = frag_ptr[f]
+        n = frag_ptr[f + 1] - start
+
+        done = np.zeros(n, dtype=np.bool_)
+        queue = np.empty(n, dtype=np.int64)
+        queue[0] = start
+        done[0] = True
+        head = 0
+        tail = 1
+        while head < tail:
+            a = queue[head]
+            head += 1
+            for k in range(bond_ptr[a], bond_ptr[a + 1]):
+                b = bond_idx[k]
+                if done[b - start]:
+                    continue
+                for d in range(3):
+                    dx = pos[b, d] - pos[a, d]
+                    pos[b, d] -= box[d] * np.floor(dx / box[d] + 0.5)
+                done[b - start] = True
+                queue[tail] = b
+                tail += 1
+
+
+try:
+    from ._kugupu_kernels import coupling_block, unwrap_fragments
+except ImportError:
+    # no fastmath, to give the same results as the ahead of time build
+    coupling_block = njit(cache=True)(_coupling_block)
+    unwrap_fragments = njit(cache=True)(_unwrap_fragments)
@@ -96,13 +96,55 @@ def count_orbitals(ag):
     return norbitals, nelectrons
 
 
-def run_fragment(ag):
+def _run_bind(pos, names):
+    """Hamiltonian and overlap matrices from yaehmop for a set of atoms
+
+    Parameters
+    ----------
+    pos : numpy array
+      positions of atoms
+    names : numpy array
+      element for each atom
+
+    Returns
+    -------
+    H_mat, S_mat : numpy array
+      Hamiltonian and Overlap matrices
+    """
+    return _pyeht.run_bind(pos, names, 0.0)
+
+
+def _get_bind(memory):
+    """Select the yaehmop runner, cached if memory is given
+
+    This should be called once per calculation and the result passed
+    around, as each call to memory.cache builds a new cached function.
+
+    Parameters
+    ----------
+    memory : joblib.Memory or None
+      on disk cache to store results in
+
+    Returns
+    -------
+    bind : function
+      function with same signature as _run_bind
+    """
+    if memory is None:
+        return _run_bind
+    # _run_bind only depends on its arguments, so is safe to memoize
+    return memory.cache(_run_bind)
+
+
+def run_fragment(ag, bind=None):
     """Run tight binding on single fragment
 
     Parameters
     ----------
     ag : mda.AtomGroup
       single fragment to run
+    bind : function, optional
+      yaehmop runner from _get_bind, defaults to the uncached _run_bind
 
     Returns
     -------
@@ -111,14 +153,16 @@ def run_fragment(ag):
     nelectrons : int
       number of valence electrons
     """
-    H_mat, S_mat = _pyeht.run_bind(ag.positions, ag.names, 0.0)
+    if bind is None:
+        bind = _run_bind
+    H_mat, S_mat = bind(ag.positions, ag.names)
     _, nelectrons = count_orbitals(ag)
 
     return H_mat, S_mat, nelectrons
 
 
-def run_dimer(ags):
-    """Tight binding calculation on pair of fragments
+def prepare_dimer(ags):
+    """Inputs for tight binding calculation on pair of fragments
 
     The positions of the pair will be shifted according
     to periodic boundaries to choose the closest image.
@@ -128,6 +172,29 @@ def run_dimer(ags):
     ags : tuple of mda.AtomGroup
       The dimer to run
 
+    Returns
+    -------
+    pos : numpy array
+      positions of both fragments
+    names : numpy array
+      element of each atom in both fragments
+    """
+    ag_i, ag_j = ags
+    pos = shift_dimer_images(ag_i, ag_j)
+
+    return pos, (ag_i + ag_j).names
+
+
+def split_dimer(ags, H_mat, S_mat):
+    """Split dimer tight binding results into per fragment blocks
+
+    Parameters
+    ----------
+    ags : tuple of mda.AtomGroup
+      The dimer that was ran
+    H_mat, S_mat : numpy array
+      Hamiltonian and Overlap matrices for the whole dimer
+
     Returns
     -------
     Hij : numpy array of off diagonal (intermolecular) Hamiltonian
@@ -136,11 +203,6 @@ def run_dimer(ags):
     (Hjj, Sjj, ele_j) : same for second fragment
     """
     ag_i, ag_j = ags
-    pos = shift_dimer_images(ag_i, ag_j)
-
-    logger.debug('Running bind')
-    H_mat, S_mat = _pyeht.run_bind(pos, (ag_i + ag_j).names, 0.0)
-
     orb_i, ele_i = count_orbitals(ag_i)
     orb_j, ele_j = count_orbitals(ag_j)
 
@@ -151,3 +213,33 @@ def run_dimer(ags):
     Sjj = S_mat[orb_i:, orb_i:]
 
     return Hij, (Hii, Sii, ele_i), (Hjj, Sjj, ele_j)
+
+
+def run_dimer(ags, bind=None):
+    """Tight binding calculation on pair of fragments
+
+    The positions of the pair will be shifted according
+    to periodic boundaries to choose the closest image.
+
+    Parameters
+    ----------
+    ags : tuple of mda.AtomGroup
+      The dimer to run
+    bind : function, optional
+      yaehmop runner from _get_bind, defaults to the uncached _run_bind
+
+    Returns
+    -------
+    Hij : numpy array of off diagonal (intermolecular) Hamiltonian
+    (Hii, Sii, ele_i) : intramolecular Hamiltonian and overlap matrix
+                        and number of electrons for first fragment
+    (Hjj, Sjj, ele_j) : same for second fragment
+    """
+    pos, names = prepare_dimer(ags)
+
+    logger.debug('Running bind')
+    if bind is None:
+        bind = _run_bind
+    H_mat, S_mat = bind(pos, names)
+
+    return split_dimer(ags, H_mat, S_mat)
@@ -32,7 +32,8 @@ def _find_contacts(fragments, cutoff):
     Returns
     -------
     frag_idx : numpy array, shape (n, 2)
-      indices of fragments that are touching, e.g. [[0, 1], [2, 3], ...]
+      unique indices of fragments that are touching, sorted,
+      e.g. [[0, 1], [2, 3], ...]
     """
     # indices of atoms within cutoff of each other
     # TODO: ALso change this line once distances not returned
@@ -50,6 +51,8 @@ def _find_contacts(fragments, cutoff):
     fragidx = translation[idx]
     # remove self contributions (i==j) and don't double count (i<j)
     fragidx = fragidx[fragidx[:, 0] < fragidx[:, 1]]
+    # many atom pairs map onto the same fragment pair
+    fragidx = np.unique(fragidx, axis=0)
 
     return fragidx
 
@@ -69,7 +72,8 @@ def find_dimers(fragments, cutoff):
     Returns
     -------
     dimers : dictionary
-      mapping of {(x, y): (ag_x, ag_y)} for all dimer pairs
+      mapping of {(x, y): (ag_x, ag_y)} for all dimer pairs, in
+      sorted order of (x, y)
     """
     logger.info("Finding dimers within {}, passed {} fragments"
                 "".format(cutoff, len(fragments)))
@@ -14,6 +14,10 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """runs the whole thing from head to toe"""
+from collections import deque
+import multiprocessing
+import os
+import threading
 
 import numpy as np
 from tqdm import tqdm
@@ -21,17 +25,23 @@ import MDAnalysis as mda
 
 from . import logger
 from . import KugupuResults
+from .results_io import BackedKugupuResults, save_partial, stitch_results
 from .dimers import find_dimers
-from ._yaehmop import run_dimer, run_fragment
+from ._yaehmop import (run_dimer, run_fragment,
+                       prepare_dimer, split_dimer, _get_bind, _run_bind)
 from ._hamiltonian_reduce import find_psi
+from ._kernels import coupling_block, unwrap_fragments
 
 # Elements known to yaehmop (default eht_parms at least...)
-REF_ELEMS = set('AC AG AL AM AR AS AT AU B BA BE BI BK BR C CA CD CE CF CL CM '
-                'CO CR CS CU DY ER ES EU F FE FM FR GA GD GE H HE HF HG HO I '
-                'IN IR K KR LA LI LR LU MD MG MN MO N NA NB ND NE NI NO NP O '
-                'OS P PA PB PD PM PO PR PT PU RA RB RE RH RN RU S SB SC SE SI '
-                'SM SN SR TA TB TC TE TH TI TL TM U UNQ V W XE Y YB ZN ZR'
-                ''.split())
+REF_ELEMS = frozenset('AC AG AL AM AR AS AT AU B BA BE BI BK BR C CA CD CE CF CL CM '
+                      'CO CR CS CU DY ER ES EU F FE FM FR GA GD GE H HE HF HG HO I '
+                      'IN IR K KR LA LI LR LU MD MG MN MO N NA NB ND NE NI NO NP O '
+                      'OS P PA PB PD PM PO PR PT PU RA RB RE RH RN RU S SB SC SE SI '
+                      'SM SN SR TA TB TC TE TH TI TL TM U UNQ V W XE Y YB ZN ZR'
+                      ''.split())
+
+# Universe cached by each worker, see _worker_universe
+_WORKER = threading.local()
 
 def _check_universe(universe):
     """Check universe is suitable for calculations
@@ -52,15 +62,159 @@ def _check_universe(universe):
     if not (hasattr(universe.atoms, 'names')):
         raise ValueError("Universe has no names, "
                          "these need to be set to element names")
-    elems = set(universe.atoms.names)
-    elems = {v.upper() for v in elems}
+    # only uppercase the unique names, not every atom
+    elems = frozenset(v.upper() for v in set(universe.atoms.names))
     new = elems - REF_ELEMS
     if new:  # if any user supplied elements not in yaehmop elements
         raise ValueError("Unknown elements found: {} "
                          "yaehmop knows of: {}".format(new, REF_ELEMS))
 
 
-def _single_frame(fragments, nn_cutoff, degeneracy, state):
+def _fragment_order(fragments):
+    """All atoms of fragments, ordered contiguously by fragment
+
+    Parameters
+    ----------
+    fragments : list of AtomGroup
+      fragments to order
+
+    Returns
+    -------
+    atoms : AtomGroup
+      all atoms, ordered by fragment
+    frag_ptr : numpy array
+      fragment f owns atoms[frag_ptr[f]:frag_ptr[f+1]]
+    """
+    ix = [f.ix for f in fragments]
+    atoms = fragments[0].universe.atoms[np.concatenate(ix)]
+    # compiled kernels expect 64 bit indices, whatever the platform default
+    frag_ptr = np.r_[0, np.cumsum([len(x) for x in ix])].astype(np.int64)
+
+    return atoms, frag_ptr
+
+
+def _fragment_graph(fragments):
+    """Flatten the bonds within fragments into a CSR layout
+
+    Parameters
+    ----------
+    fragments : list of AtomGroup
+      all fragments in system
+
+    Returns
+    -------
+    atoms : AtomGroup
+      all atoms, ordered by fragment
+    frag_ptr : numpy array
+      fragment f owns atoms[frag_ptr[f]:frag_ptr[f+1]]
+    bond_ptr, bond_idx : numpy array
+      atoms[a] is bonded to atoms[bond_idx[bond_ptr[a]:bond_ptr[a+1]]]
+    """
+    atoms, frag_ptr = _fragment_order(fragments)
+
+    # translation array from atom index to position in atoms
+    lookup = np.full(atoms.ix.max() + 1, -1, dtype=np.int64)
+    lookup[atoms.ix] = np.arange(len(atoms))
+    bonds = lookup[atoms.bonds.indices]
+    # each bond is walkable in both directions
+    src = np.concatenate([bonds[:, 0], bonds[:, 1]])
+    dst = np.concatenate([bonds[:, 1], bonds[:, 0]])
+
+    # int64 for the compiled kernels, as with frag_ptr
+    bond_idx = dst[np.argsort(src, kind='stable')].astype(np.int64)
+    bond_ptr = np.r_[0, np.cumsum(np.bincount(src, minlength=len(atoms)))]
+    bond_ptr = bond_ptr.astype(np.int64)
+
+    return atoms, frag_ptr, bond_ptr, bond_idx
+
+
+def _make_whole(fragments, graph):
+    """Make all fragments whole, ie not split between periodic images
+
+    Parameters
+    ----------
+    fragments : list of AtomGroup
+      all fragments in system
+    graph : tuple
+      output of _fragment_graph for these fragments
+    """
+    box = fragments[0].dimensions
+    if not np.allclose(box[3:], 90.0):
+        # kernel only handles orthorhombic boxes
+        for frag in fragments:
+            mda.lib.mdamath.make_whole(frag)
+        return
+
+    atoms, frag_ptr, bond_ptr, bond_idx = graph
+    pos = atoms.positions
+    unwrap_fragments(pos, frag_ptr, bond_ptr, bond_idx,
+                     box[:3].astype(pos.dtype))
+    atoms.positions = pos
+
+
+def _H_frag_layout(degeneracy):
+    """Start and stop of each fragment's states in H_frag
+
+    Parameters
+    ----------
+    degeneracy : numpy array
+      degenerate states per fragment
+
+    Returns
+    -------
+    size : int
+      size of H_frag
+    starts, stops : numpy array
+      fragment i occupies H_frag[starts[i]:stops[i]]
+    """
+    stops = np.cumsum(degeneracy)
+    starts = np.r_[0, stops[:-1]]
+
+    return int(stops[-1]), starts, stops
+
+
+def _run_dimers(dimers, bind=None, executor=None):
+    """Run tight binding calculations on all dimers
+
+    Parameters
+    ----------
+    dimers : dict
+      mapping of {(x, y): (ag_x, ag_y)}, from find_dimers
+    bind : function, optional
+      yaehmop runner from _get_bind, possibly cached
+    executor : concurrent.futures.Executor, optional
+      if given, dimers are submitted to this ahead of being yielded,
+      so that several are calculated at once
+
+    Yields
+    ------
+    (x, y), results
+      dimer indices and the output of run_dimer, in the order of dimers
+    """
+    if executor is None:
+        for (i, j), ags in dimers.items():
+            logger.debug('Calculating dimer {}-{}'.format(i, j))
+            yield (i, j), run_dimer(ags, bind)
+        return
+
+    if bind is None:
+        bind = _run_bind
+    # limit how many dimers are held in memory at once
+    window = 2 * (os.cpu_count() or 1)
+    pending = deque()
+    for (i, j), ags in dimers.items():
+        logger.debug('Submitting dimer {}-{}'.format(i, j))
+        pending.append(((i, j), ags, executor.submit(bind, *prepare_dimer(ags))))
+        if len(pending) >= window:
+            key, ags, fut = pending.popleft()
+            yield key, split_dimer(ags, *fut.result())
+    while pending:
+        key, ags, fut = pending.popleft()
+        yield key, split_dimer(ags, *fut.result())
+
+
+def _single_frame(fragments, nn_cutoff, degeneracy, state, bind=None,
+                  graph=None, layout=None, out=None, executor=None):
     """Results for a single frame
 
     Parameters
@@ -73,79 +227,132 @@ def _single_frame(fragments, nn_cutoff, degeneracy, state):
       degenerate states per fragment
     state : str
       'homo' or 'lumo'
+    bind : function, optional
+      yaehmop runner from _get_bind, possibly cached
+    graph : tuple, optional
+      output of _fragment_graph for fragments, built if not given
+    layout : tuple, optional
+      output of _H_frag_layout for degeneracy, built if not given
+    out : numpy array, optional
+      zeroed array of shape (size, size) to write the coupling matrix into,
+      allocated if not given
+    executor : concurrent.futures.Executor, optional
+      if given, dimer calculations are run concurrently using this
 
     Returns
     -------
     H_frag : numpy array
       coupling matrix
     """
+    if graph is None:
+        graph = _fragment_graph(fragments)
     # make sure that all fragments are whole
     # ie a fragment isn't split between periodic images
-    for frag in fragments:
-        mda.lib.mdamath.make_whole(frag)
+    _make_whole(fragments, graph)
     dimers = find_dimers(fragments, nn_cutoff)
 
-    size = degeneracy.sum()
-    H_frag = np.zeros((size, size))
+    if layout is None:
+        layout = _H_frag_layout(degeneracy)
     # start and stop indices for each fragment
-    stops = np.cumsum(degeneracy)
-    starts = np.r_[0, stops[:-1]]
-    diag = np.arange(size)  # diagonal indices
-    wave = dict()  # wavefunctions for each fragment
+    size, starts, stops = layout
+    if out is None:
+        H_frag = np.zeros((size, size))
+    else:
+        H_frag = out
+    # wavefunctions for each fragment, None until calculated
+    wave = [None] * len(fragments)
 
-    for (i, j), ags in tqdm(sorted(dimers.items())):
+    # call Yaehmop
+    for (i, j), (Hij, frag_i, frag_j) in tqdm(_run_dimers(dimers, bind, executor),
+                                              total=len(dimers)):
         # indices for indexing H_frag for each fragment
         ix, iy = starts[i], stops[i]
         jx, jy = starts[j], stops[j]
 
-        logger.debug('Calculating dimer {}-{}'.format(i, j))
-        # call Yaehmop
-        Hij, frag_i, frag_j = run_dimer(ags)
-
         # lazily calculate the wave function for i and j
-        try:
-            # If we already did fragment i, just retrieve psi
-            psi_i = wave[i]
-        except KeyError:
+        # If we already did fragment i, just retrieve psi
+        psi_i = wave[i]
+        if psi_i is None:
             # If we didn't have fragment i already done,
             # calculate the state energy and wavefunction
             e_i, psi_i = find_psi(frag_i[0], frag_i[1], frag_i[2],
                                   state, degeneracy[i])
             # fill diagonal with energy of states
             # this only has to be one as self contribution does not change
-            H_frag[diag[ix:iy], diag[ix:iy]] = e_i
+            np.fill_diagonal(H_frag[ix:iy, ix:iy], e_i)
             # store the wavefunction for future use
             wave[i] = psi_i
 
-        try:
-            psi_j = wave[j]
-        except KeyError:
+        psi_j = wave[j]
+        if psi_j is None:
             e_j, psi_j = find_psi(frag_j[0], frag_j[1], frag_j[2],
                                   state, degeneracy[j])
-            H_frag[diag[jx:jy], diag[jx:jy]] = e_j
+            np.fill_diagonal(H_frag[jx:jy, jx:jy], e_j)
             wave[j] = psi_j
 
 
         # H = <psi_i|Hij|psi_j>
-        H_frag[ix:iy, jx:jy] = abs(psi_i.T.dot(Hij).dot(psi_j))
-        H_frag[jx:jy, ix:iy] = H_frag[ix:iy, jx:jy]
+        coupling_block(H_frag, psi_i, Hij, psi_j, ix, jx)
 
     # do single fragment calculations for all missing
-    for i in (set(range(len(degeneracy))) - set(wave.keys())):
+    missing = [i for i, w in enumerate(wave) if w is None]
+    for i in missing:
         ix, iy = starts[i], stops[i]
         logger.debug('Calculating lone fragment {}'.format(i))
-        H, S, ele = run_fragment(fragments[i])
+        H, S, ele = run_fragment(fragments[i], bind)
 
         e_i, psi_i = find_psi(H, S, ele, state, degeneracy[i])
 
-        H_frag[diag[ix:iy], diag[ix:iy]] = e_i
+        np.fill_diagonal(H_frag[ix:iy, ix:iy], e_i)
         # don't need to save the psi for this fragment
         #wave[i] = psi_i
 
     return H_frag
 
 
-def _dask_single(top, trj, frame, nn_cutoff, degeneracy, state):
+def _worker_universe(top, trj):
+    """Fetch the Universe for this worker, only building it on first use
+
+    Parsing the topology and opening the trajectory is done once per
+    worker thread rather than once per frame.  The cache is thread local
+    as a dask worker can run several tasks at once.
+
+    Parameters
+    ----------
+    top : pickle
+      pickled MDAnalysis Topology
+    trj : str
+      filename to the trajectory file
+
+    Returns
+    -------
+    u : mda.Universe
+    fragments : list of AtomGroup
+      all fragments in u
+    graph : tuple
+      output of _fragment_graph for fragments
+    """
+    # the cached Universe holds a reference to top,
+    # so its id can't be recycled while it is cached
+    key = (id(top), trj)
+    cached = getattr(_WORKER, 'universe', None)
+    if cached is None or cached[0] != key:
+        u = mda.Universe(top)
+        u.load_new(trj)
+        fragments = u.atoms.fragments
+        cached = (key, u, fragments, _fragment_graph(fragments))
+        _WORKER.universe = cached
+
+    return cached[1:]
+
+
+def _init_worker(top, trj):
+    """Multiprocessing initializer, builds the Universe for this process"""
+    _worker_universe(top, trj)
+
+
+def _dask_single(top, trj, frame, nn_cutoff, degeneracy, state, bind,
+                 layout, partial_dir=None):
     """Dask helper function for calculating a single frame
 
     Parameters
@@ -156,25 +363,89 @@ def _dask_single(top, trj, frame, nn_cutoff, degeneracy, state):
       filename to the trajectory file
     frame : int
       index of the frame to analyse
-    nn_cutoff, degeneracy, state
+    nn_cutoff, degeneracy, state, bind, layout
       same as for _single_frame
+    partial_dir : str, optional
+      if given, the result is saved to a file in this directory
+
+    Returns
+    -------
+    H_frag : numpy array or str
+      coupling matrix, or if partial_dir was given the file it was saved to
 
     Reheats the MDAnalysis Universe, loads correct frame then calls _single_frame
     """
-    # load the Universe
-    u = mda.Universe(top)
-    u.load_new(trj)
+    # load the Universe, reusing the one already on this worker if possible
+    u, fragments, graph = _worker_universe(top, trj)
     # select correct frame
     u.trajectory[frame]
 
-    res = _single_frame(u.atoms.fragments, nn_cutoff, degeneracy, state)
+    res = _single_frame(fragments, nn_cutoff, degeneracy, state,
+                        bind, graph, layout)
+
+    if partial_dir is not None:
+        filename = os.path.join(partial_dir, 'partial_{:06d}.hdf5'.format(frame))
+        save_partial(filename, res)
+        return filename
 
     return res
 
 
+def _run_block(frames, nn_cutoff, degeneracy, state, bind, layout):
+    """Multiprocessing helper function for calculating a block of frames
+
+    Parameters
+    ----------
+    frames : numpy array
+      indices of the frames to analyse
+    nn_cutoff, degeneracy, state, bind, layout
+      same as for _single_frame
+
+    Returns
+    -------
+    H_frag : numpy array
+      coupling matrix for each frame in block, shape (nblock, size, size)
+
+    Uses the Universe built by _init_worker for this process, then calls
+    _single_frame on each frame in the block
+    """
+    u, fragments, graph = _WORKER.universe[1:]
+
+    size = layout[0]
+    H_frag = np.zeros((len(frames), size, size))
+    for i, frame in enumerate(frames):
+        u.trajectory[frame]
+        _single_frame(fragments, nn_cutoff, degeneracy, state,
+                      bind, graph, layout, out=H_frag[i])
+
+    return H_frag
+
+
+def _multiprocessing_coupling(n_workers,
+                              u, nn_cutoff, degeneracy, state, bind, layout,
+                              start=None, stop=None, step=None):
+    frames = np.arange(len(u.trajectory))[start:stop:step]
+    # contiguous block of frames for each worker
+    blocks = [b for b in np.array_split(frames, n_workers) if len(b)]
+
+    args = [(block, nn_cutoff, degeneracy, state, bind, layout)
+            for block in blocks]
+    with multiprocessing.Pool(n_workers,
+                              initializer=_init_worker,
+                              initargs=(u._topology, u.trajectory.filename)) as pool:
+        results = pool.starmap(_run_block, args)
+
+    return np.concatenate(results)
+
+
+def _stitched_filename(partial_dir):
+    """Results file that frames saved to partial_dir are combined into"""
+    return os.path.join(partial_dir, 'results.hdf5')
+
+
 def _dask_coupling(client,
-                   u, nn_cutoff, degeneracy, state,
-                   start=None, stop=None, step=None):
+                   u, nn_cutoff, degeneracy, state, bind, layout,
+                   start=None, stop=None, step=None, partial_dir=None):
     import dask
 
     frames = np.arange(len(u.trajectory))
@@ -184,13 +455,23 @@ def _dask_coupling(client,
     futures = []
     for i in frames[start:stop:step]:
         futures.append(dask.delayed(_dask_single)(future_top, u.trajectory.filename,
-                                                  i, nn_cutoff, degeneracy, state))
+                                                  i, nn_cutoff, degeneracy, state,
+                                                  bind, layout, partial_dir))
+
+    if partial_dir is not None:
+        # workers hand back filenames, the matrices stay on disk
+        partials = client.gather(client.compute(futures))
+        filename = _stitched_filename(partial_dir)
+        stitch_results(filename, partials, frames[start:stop:step], degeneracy)
+        return filename
 
     return client.compute(dask.delayed(np.stack)(futures)).result()
 
 
 def coupling_matrix(u, nn_cutoff, state, degeneracy=None,
-                    start=None, stop=None, step=None, client=None):
+                    start=None, stop=None, step=None, client=None,
+                    n_workers=None, cache_dir=None, executor=None,
+                    partial_dir=None):
     """Generate Hamiltonian matrix H_frag for each frame in trajectory
 
     Parameters
@@ -214,6 +495,27 @@ def coupling_matrix(u, nn_cutoff, state, degeneracy=None,
     client : dask distributed Client, optional
       if given, coupling matrix will be calculated in parallel as a
       dask distributed job using this client
+    n_workers : int, optional
+      if given, coupling matrix will be calculated in parallel using this
+      many processes, each analysing a contiguous block of frames.
+      Ignored if client is given.
+    cache_dir : str, optional
+      if given, tight binding calculations are memoized on disk in this
+      directory, so that repeated calculations on identical coordinates
+      (e.g. when rerunning an overlapping set of frames) are only done once.
+      Requires joblib.
+    executor : concurrent.futures.ProcessPoolExecutor, optional
+      if given, the dimer calculations within each frame are calculated in
+      parallel using this.  yaehmop is not thread safe, so this must be a
+      process based executor.  Only used if neither client nor n_workers
+      are given.
+    partial_dir : str, optional
+      only used with client.  Each frame is saved by the worker to its own
+      file in this directory, which must be visible to all workers.  These
+      are then combined into 'results.hdf5' in the same directory, without
+      the coupling matrices ever being gathered into memory, and a
+      BackedKugupuResults for this file is returned.  'results.hdf5' must
+      not already exist.
 
     Returns
     -------
@@ -222,10 +524,15 @@ def coupling_matrix(u, nn_cutoff, state, degeneracy=None,
       - frames: index of each frame analysed
       - degeneracy: degeneracy for each fragment in Universe
       - H_frag: coupling between different fragments
+      if partial_dir was given, a BackedKugupuResults with the same
+      attributes is returned instead
     """
     _check_universe(u)
-
-    Hs, frames = [], []
+    if client is not None and partial_dir is not None:
+        # check before any frames are calculated, not when stitching at the end
+        if os.path.exists(_stitched_filename(partial_dir)):
+            raise ValueError("Results file {} already exists"
+                             "".format(_stitched_filename(partial_dir)))
 
     nframes = len(u.trajectory[start:stop:step])
     logger.info("Processing {} frames".format(nframes))
@@ -238,28 +545,57 @@ def coupling_matrix(u, nn_cutoff, state, degeneracy=None,
         elif isinstance(degeneracy, dict):
             # if our system is multi-component,
             # different residues have different degeneracy
-            deg_arr = np.zeros(len(u.atoms.fragments))
+            deg_arr = np.zeros(len(u.atoms.fragments), dtype=int)
             for i, frag in enumerate(u.atoms.fragments):
                 # for a molecule with more than 1 residue,
                 #  only the 1st one is checked
                 deg_arr[i] = degeneracy[frag.residues[0].resname]
             degeneracy = deg_arr
 
-    if client is None:
-        for i, ts in enumerate(u.trajectory[start:stop:step]):
-            logger.info("Processing frame {} of {}"
-                        "".format(i + 1, nframes))
-            H_frag = _single_frame(u.atoms.fragments, nn_cutoff, degeneracy, state)
+    if cache_dir is not None:
+        import joblib
 
-            frames.append(ts.frame)
-            Hs.append(H_frag)
-        H_frag = np.stack(Hs)
-        frames = np.array(frames)
+        memory = joblib.Memory(cache_dir, verbose=0)
     else:
+        memory = None
+    # built once here, each memory.cache call makes a new cached function
+    bind = _get_bind(memory)
+
+    # degeneracy is fixed, so the layout is shared by every frame
+    layout = _H_frag_layout(degeneracy)
+
+    if client is not None and partial_dir is not None:
+        filename = _dask_coupling(client, u,
+                                  nn_cutoff, degeneracy, state, bind, layout,
+                                  start, stop, step, partial_dir)
+        logger.info('Done!')
+        return BackedKugupuResults(filename)
+    elif client is not None:
         H_frag = _dask_coupling(client, u,
-                                nn_cutoff, degeneracy, state,
+                                nn_cutoff, degeneracy, state, bind, layout,
                                 start, stop, step)
         frames = np.arange(len(u.trajectory))[start:stop:step]
+    elif n_workers is not None and n_workers > 1:
+        H_frag = _multiprocessing_coupling(n_workers, u,
+                                           nn_cutoff, degeneracy, state, bind, layout,
+                                           start, stop, step)
+        frames = np.arange(len(u.trajectory))[start:stop:step]
+    else:
+        fragments = u.atoms.fragments
+        # topology is fixed, so the bond graph is shared by every frame
+        graph = _fragment_graph(fragments)
+        size = layout[0]
+        # filled in place frame by frame
+        H_frag = np.zeros((nframes, size, size))
+        frames = np.zeros(nframes, dtype=int)
+        for i, ts in enumerate(u.trajectory[start:stop:step]):
+            logger.info("Processing frame {} of {}"
+                        "".format(i + 1, nframes))
+            _single_frame(fragments, nn_cutoff, degeneracy, state,
+                          bind, graph, layout, out=H_frag[i],
+                          executor=executor)
+
+            frames[i] = ts.frame
 
     logger.info('Done!')
     return KugupuResults(
@@ -18,6 +18,7 @@
 """
 from collections import namedtuple
 from datetime import datetime
+import os
 import numpy as np
 import h5py
 
@@ -33,6 +34,81 @@ KugupuResults = namedtuple("KugupuResults",
 _DATEFORMAT = '%Y-%m-%d %H:%M:%S'
 
 
+def _pack_sym(H):
+    """Pack symmetric matrices into their upper triangles
+
+    Parameters
+    ----------
+    H : numpy array
+      symmetric matrices, shape (..., size, size)
+
+    Returns
+    -------
+    packed : numpy array
+      upper triangle of each matrix, shape (..., size * (size + 1) // 2)
+    """
+    iu = np.triu_indices(H.shape[-1])
+    return H[..., iu[0], iu[1]]
+
+
+def _unpack_sym(packed, size):
+    """Inverse of _pack_sym
+
+    Parameters
+    ----------
+    packed : numpy array
+      upper triangles, shape (..., size * (size + 1) // 2)
+    size : int
+      size of the square matrices
+
+    Returns
+    -------
+    H : numpy array
+      full symmetric matrices, shape (..., size, size)
+    """
+    iu = np.triu_indices(size)
+    H = np.zeros(packed.shape[:-1] + (size, size), dtype=packed.dtype)
+    H[..., iu[0], iu[1]] = packed
+    H[..., iu[1], iu[0]] = packed
+    return H
+
+
+class _PackedDataset(object):
+    """Read only view of a packed H_frag dataset which unpacks on indexing"""
+    def __init__(self, dataset, size):
+        self._dataset = dataset
+        self._size = size
+        self.shape = dataset.shape[:1] + (size, size)
+        self.dtype = dataset.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, item):
+        # split into selection of frames and selection within each frame
+        if not isinstance(item, tuple):
+            item = (item,)
+        if not item or item[0] is Ellipsis:
+            frames, rest = slice(None), item
+        else:
+            frames, rest = item[0], item[1:]
+
+        if len(rest) == 2 and all(isinstance(x, (int, np.integer)) for x in rest):
+            # single element, only read that column of the packed data
+            for x in rest:
+                if not -self._size <= x < self._size:
+                    raise IndexError("index {} is out of bounds for axis "
+                                     "with size {}".format(x, self._size))
+            i, j = sorted(x % self._size for x in rest)
+            col = i * self._size - i * (i - 1) // 2 + (j - i)
+            return self._dataset[frames, col]
+
+        H = _unpack_sym(self._dataset[frames], self._size)
+        if isinstance(frames, (int, np.integer)):
+            return H[rest]
+        return H[(slice(None),) + rest]
+
+
 def save_results(filename, results):
     """Save Kugupu results to HDF5 file
 
@@ -42,7 +118,13 @@ def save_results(filename, results):
       filename, must not yet exist.  '.hdf5' will be appended
       if not present
     results : kugupu.Results namedtuple
-      finished results to save to file
+      finished results to save to file.  H_frag must be symmetric,
+      as only its upper triangle is stored
+
+    Notes
+    -----
+    H_frag is stored as single precision (float32), giving a precision
+    of around 1e-6 eV, well beyond that of the tight binding couplings.
     """
     if not filename.endswith('.hdf5'):
         filename += '.hdf5'
@@ -53,17 +135,100 @@ def save_results(filename, results):
         f.attrs['creation_date'] = datetime.now().strftime(_DATEFORMAT)
 
         f['frames'] = results.frames
-        f['H_frag'] = results.H_frag
+        # H_frag is symmetric, so only the upper triangle is stored
+        # one chunk per frame, so single frames can be read back cheaply
+        nframes, size = results.H_frag.shape[:2]
+        npacked = size * (size + 1) // 2
+        H_frag = f.create_dataset('H_frag', shape=(nframes, npacked),
+                                  dtype=np.float32,
+                                  chunks=(1, npacked),
+                                  compression='lzf', shuffle=True)
+        H_frag.attrs['packed'] = True
+        for i, H in enumerate(results.H_frag):
+            H_frag[i] = _pack_sym(H)
         f['degeneracy'] = results.degeneracy
 
 
-def load_results(filename):
+def save_partial(filename, H_frag):
+    """Save the coupling matrix for a single frame
+
+    These files are combined into a results file by stitch_results
+
+    Parameters
+    ----------
+    filename : str
+      filename to write to, will be overwritten if it exists
+    H_frag : numpy array
+      symmetric coupling matrix for a single frame
+    """
+    with h5py.File(filename, 'w') as f:
+        f['H_frag'] = _pack_sym(H_frag).astype(np.float32)
+
+
+def stitch_results(filename, partials, frames, degeneracy):
+    """Combine single frame files into a Kugupu results file
+
+    H_frag is created as a HDF5 virtual dataset which refers to the data
+    in each of the partial files, so the coupling matrices are never
+    copied or loaded into memory.  The partial files must stay next
+    to the results file, which can be read as normal.
+
+    Parameters
+    ----------
+    filename : str
+      filename, must not yet exist.  Must be in the same directory
+      as the partial files
+    partials : list of str
+      files written by save_partial, in frame order
+    frames : numpy array
+      index of the frame in each partial file
+    degeneracy : numpy array
+      degeneracy for each fragment
+    """
+    size = int(degeneracy.sum())
+    npacked = size * (size + 1) // 2
+
+    logger.debug("Stitching {} frames into {}".format(len(partials), filename))
+    layout = h5py.VirtualLayout(shape=(len(partials), npacked), dtype='f4')
+    for i, partial in enumerate(partials):
+        # relative paths are resolved relative to the results file
+        layout[i] = h5py.VirtualSource(os.path.basename(partial), 'H_frag',
+                                       shape=(npacked,))
+
+    with h5py.File(filename, 'w-') as f:
+        f.attrs['kugupu_version'] = __version__
+        f.attrs['creation_date'] = datetime.now().strftime(_DATEFORMAT)
+
+        f['frames'] = frames
+        H_frag = f.create_virtual_dataset('H_frag', layout)
+        H_frag.attrs['packed'] = True
+        f['degeneracy'] = degeneracy
+
+
+def _H_frag_dataset(f, degeneracy):
+    """Get H_frag from open results file, unpacking it if required
+
+    Files written before packing was introduced hold the full matrices
+    """
+    H_frag = f['H_frag']
+    if H_frag.attrs.get('packed', False):
+        H_frag = _PackedDataset(H_frag, int(degeneracy.sum()))
+    return H_frag
+
+
+def load_results(filename, frames=None, dtype=None):
     """Load Kugupu results from HDF5 file
 
     Parameters
     ----------
     filename : str
       path to HDF5 file
+    frames : slice, optional
+      which frames of the file to load, default all.  Only these frames
+      are read from disk
+    dtype : numpy dtype, optional
+      type to convert H_frag to, by default it is returned as stored,
+      which is float32 for files written by this version
 
     Returns
     -------
@@ -80,9 +245,13 @@ def load_results(filename):
                                                  _DATEFORMAT)))
         logger.debug("Saved with version: {}"
                      "".format(f.attrs['kugupu_version']))
-        idx = f['frames'][()]
-        H_frag = f['H_frag'][()]
+        if frames is None:
+            frames = slice(None)
+        idx = f['frames'][frames]
         deg = f['degeneracy'][()]
+        H_frag = _H_frag_dataset(f, deg)[frames]
+    if dtype is not None:
+        H_frag = H_frag.astype(dtype)
 
     return KugupuResults(
         frames=idx,
@@ -91,6 +260,47 @@ def load_results(filename):
     )
 
 
+class BackedKugupuResults(object):
+    """Kugupu results which are only read from HDF5 file when indexed
+
+    The file is kept open until close is called, use as a context manager
+    to do this automatically.  Has the same attributes as KugupuResults,
+    but H_frag is a Dataset like object which loads frames as it is sliced.
+
+    Parameters
+    ----------
+    filename : str
+      path to HDF5 file
+
+    Example
+    -------
+    >>> with BackedKugupuResults('results.hdf5') as r:
+    ...     H = r.H_frag[10]  # only reads the 10th frame
+    """
+    def __init__(self, filename):
+        if not filename.endswith('.hdf5'):
+            filename += '.hdf5'
+
+        logger.debug("Opening results from {}".format(filename))
+        self._file = h5py.File(filename, 'r')
+        self.frames = self._file['frames'][()]
+        self.degeneracy = self._file['degeneracy'][()]
+        self.H_frag = _H_frag_dataset(self._file, self.degeneracy)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Close the underlying HDF5 file"""
+        self._file.close()
+
+
 def concatenate_results(*results):
     """Concatenate two result sets
 
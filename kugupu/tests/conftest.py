@@ -74,3 +74,16 @@ def ref_results(results_file):
     return kgp.load_results(results_file)
 
 
+
+
+@pytest.fixture
+def symmetric_results(in_tmpdir):
+    # random results with symmetric coupling matrices, saved to 'test.hdf5'
+    H_frag = np.random.random((6, 12, 12))
+    H_frag += H_frag.transpose(0, 2, 1)
+    res = kgp.KugupuResults(frames=np.arange(6),
+                            H_frag=H_frag,
+                            degeneracy=np.ones(12, dtype=int))
+    kgp.save_results('test', res)
+
+    return res
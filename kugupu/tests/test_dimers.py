@@ -30,3 +30,10 @@ def test_find_dimers_thorough(u):
     assert len(ref) == len(dims)
     for val in ref:
         assert val in dims
+
+
+def test_find_dimers_ordered(u):
+    dims = dimers.find_dimers(u.atoms.fragments, 5.0)
+
+    keys = list(dims.keys())
+    assert keys == sorted(keys)
@@ -0,0 +1,38 @@
+"""Tests for the numba compiled kernels"""
+import numpy as np
+import pytest
+from numpy.testing import assert_almost_equal
+
+from kugupu import _kernels
+
+
+@pytest.mark.parametrize('deg_i,deg_j', [(1, 1), (2, 2), (1, 3), (3, 1)])
+def test_coupling_block(deg_i, deg_j):
+    rng = np.random.RandomState(42)
+    psi_i = rng.random_sample((10, deg_i))
+    psi_j = rng.random_sample((12, deg_j))
+    Hij = rng.random_sample((10, 12)) - 0.5
+
+    H_frag = np.zeros((8, 8))
+    _kernels.coupling_block(H_frag, psi_i, Hij, psi_j, 1, 4)
+
+    ref = np.abs(psi_i.T.dot(Hij).dot(psi_j))
+    assert_almost_equal(H_frag[1:1 + deg_i, 4:4 + deg_j], ref)
+    assert_almost_equal(H_frag[4:4 + deg_j, 1:1 + deg_i], ref.T)
+
+
+def test_make_whole(u):
+    import MDAnalysis as mda
+    from kugupu.generate_results import _fragment_graph, _make_whole
+
+    frags = u.atoms.fragments
+    orig = u.atoms.positions
+
+    for f in frags:
+        mda.lib.mdamath.make_whole(f)
+    ref = u.atoms.positions
+
+    u.atoms.positions = orig
+    _make_whole(frags, _fragment_graph(frags))
+
+    assert_almost_equal(u.atoms.positions, ref, decimal=3)
@@ -63,3 +63,89 @@ def test_slicing_options(mini_u, mini_ix, ref_results, start, stop, step):
     for H_ref, H_new in zip(ref_results.H_frag[slice(start, stop, step)],
                             results.H_frag):
         assert_almost_equal(abs(H_ref[ix]), abs(H_new))
+
+
+def test_multiprocessing(mini_u, mini_ix, ref_results):
+    ix = np.ix_(mini_ix, mini_ix)
+
+    results = kgp.coupling_matrix(mini_u,
+                                  nn_cutoff=5.0, degeneracy=1,
+                                  state='lumo', stop=6,
+                                  n_workers=2)
+
+    assert results.H_frag.shape[0] == 6
+    for H_ref, H_new in zip(ref_results.H_frag[:6],
+                            results.H_frag):
+        assert_almost_equal(abs(H_ref[ix]), abs(H_new), decimal=3)
+
+
+def test_cache_dir(mini_u, tmp_path, monkeypatch):
+    pytest.importorskip('joblib')
+    from kugupu import _yaehmop
+
+    ref = kgp.coupling_matrix(mini_u,
+                              nn_cutoff=5.0, degeneracy=1,
+                              state='lumo', stop=2)
+
+    ncalls = []
+    run_bind = _yaehmop._pyeht.run_bind
+
+    def counting_run_bind(*args):
+        ncalls.append(1)
+        return run_bind(*args)
+
+    monkeypatch.setattr(_yaehmop._pyeht, 'run_bind', counting_run_bind)
+
+    # first pass fills the cache, second reads yaehmop results back from it
+    for expected_calls in (True, False):
+        del ncalls[:]
+        results = kgp.coupling_matrix(mini_u,
+                                      nn_cutoff=5.0, degeneracy=1,
+                                      state='lumo', stop=2,
+                                      cache_dir=str(tmp_path))
+        assert_almost_equal(ref.H_frag, results.H_frag)
+        assert bool(ncalls) == expected_calls
+
+
+def test_dimer_executor(mini_u, mini_ix, ref_results):
+    from concurrent.futures import ProcessPoolExecutor
+
+    ix = np.ix_(mini_ix, mini_ix)
+
+    with ProcessPoolExecutor(2) as ex:
+        results = kgp.coupling_matrix(mini_u,
+                                      nn_cutoff=5.0, degeneracy=1,
+                                      state='lumo', stop=2,
+                                      executor=ex)
+
+    for H_ref, H_new in zip(ref_results.H_frag[:2],
+                            results.H_frag):
+        assert_almost_equal(abs(H_ref[ix]), abs(H_new), decimal=3)
+
+
+def test_dask_partial_dir(mini_u, mini_ix, ref_results, tmp_path):
+    distributed = pytest.importorskip('distributed')
+
+    ix = np.ix_(mini_ix, mini_ix)
+
+    with distributed.LocalCluster(n_workers=2, threads_per_worker=1) as cluster, \
+            distributed.Client(cluster) as client:
+        results = kgp.coupling_matrix(mini_u,
+                                      nn_cutoff=5.0, degeneracy=1,
+                                      state='lumo', stop=4,
+                                      client=client,
+                                      partial_dir=str(tmp_path))
+        with results:
+            assert isinstance(results, kgp.BackedKugupuResults)
+            assert len(results) == 4
+            for H_ref, i in zip(ref_results.H_frag[:4], range(4)):
+                assert_almost_equal(abs(H_ref[ix]), results.H_frag[i],
+                                    decimal=3)
+
+        # rerunning into the same directory fails before doing any work
+        with pytest.raises(ValueError):
+            kgp.coupling_matrix(mini_u,
+                                nn_cutoff=5.0, degeneracy=1,
+                                state='lumo', stop=4,
+                                client=client,
+                                partial_dir=str(tmp_path))
@@ -3,6 +3,7 @@ import h5py
 import kugupu as kgp
 import numpy as np
 import os
+import pytest
 
 from numpy.testing import assert_almost_equal, assert_equal
 
@@ -29,6 +30,8 @@ def test_metadata(results_file):
 
 def test_save_results(in_tmpdir):
     H_frag = np.random.random((5, 50, 50))
+    # coupling matrices are symmetric
+    H_frag += H_frag.transpose(0, 2, 1)
     deg = np.ones(50, dtype=int)
     frames = np.arange(5)
 
@@ -45,3 +48,100 @@ def test_save_results(in_tmpdir):
     assert_almost_equal(res.H_frag, res2.H_frag)
     assert_equal(res.degeneracy, res2.degeneracy)
     assert_equal(res.frames, res2.frames)
+
+
+def test_load_results_frames(results_file, ref_results):
+    r = kgp.load_results(results_file, frames=slice(5, 15, 2))
+
+    assert r.H_frag.shape == (5, 200, 200)
+    assert_equal(r.frames, ref_results.frames[5:15:2])
+    assert_almost_equal(r.H_frag, ref_results.H_frag[5:15:2])
+
+
+def test_backed_results(results_file, ref_results):
+    with kgp.BackedKugupuResults(results_file) as r:
+        assert len(r) == 20
+        assert_equal(r.frames, ref_results.frames)
+        assert_equal(r.degeneracy, ref_results.degeneracy)
+        assert_almost_equal(r.H_frag[3], ref_results.H_frag[3])
+
+
+def test_pack_sym():
+    from kugupu.results_io import _pack_sym, _unpack_sym
+
+    H = np.random.random((3, 10, 10))
+    H += H.transpose(0, 2, 1)
+
+    packed = _pack_sym(H)
+    assert packed.shape == (3, 55)
+    assert_equal(_unpack_sym(packed, 10), H)
+
+
+def test_save_results_packed(symmetric_results):
+    H_frag = symmetric_results.H_frag
+
+    with h5py.File('test.hdf5', 'r') as f:
+        assert f['H_frag'].attrs['packed']
+        assert f['H_frag'].shape == (6, 12 * 13 // 2)
+
+    assert_almost_equal(kgp.load_results('test').H_frag, H_frag, decimal=6)
+    with kgp.BackedKugupuResults('test') as r:
+        assert r.H_frag.shape == (6, 12, 12)
+        assert_almost_equal(r.H_frag[2], H_frag[2], decimal=6)
+
+
+def test_stitch_results(symmetric_results):
+    from kugupu.results_io import save_partial, stitch_results
+
+    H_frag = symmetric_results.H_frag
+    frames = symmetric_results.frames * 2
+    deg = symmetric_results.degeneracy
+
+    partials = []
+    for i, H in zip(frames, H_frag):
+        fn = 'partial_{:06d}.hdf5'.format(i)
+        save_partial(fn, H)
+        partials.append(fn)
+    stitch_results('stitched.hdf5', partials, frames, deg)
+
+    res = kgp.load_results('stitched')
+    assert_almost_equal(res.H_frag, H_frag, decimal=6)
+    assert_equal(res.frames, frames)
+    assert_equal(res.degeneracy, deg)
+
+
+def test_save_results_float32(symmetric_results):
+    assert kgp.load_results('test').H_frag.dtype == np.float32
+    res2 = kgp.load_results('test', dtype=np.float64)
+    assert res2.H_frag.dtype == np.float64
+    assert_almost_equal(res2.H_frag, symmetric_results.H_frag, decimal=6)
+
+
+def test_saved_results_lifetimes(symmetric_results):
+    # results saved as float32 can go straight into lifetime analysis
+    loaded = kgp.load_results('test')
+    assert loaded.H_frag.dtype == np.float32
+
+    d, o = kgp.time.determine_lifetimes(loaded.H_frag, 1.0)
+    d_ref, o_ref = kgp.time.determine_lifetimes(
+        loaded.H_frag.astype(np.float64), 1.0)
+
+    assert_equal(d, d_ref)
+    assert_equal(o, o_ref)
+
+
+def test_packed_indexing(symmetric_results):
+    H_frag = symmetric_results.H_frag
+
+    with kgp.BackedKugupuResults('test') as r:
+        assert_almost_equal(r.H_frag[:, 3, 7], H_frag[:, 3, 7], decimal=6)
+        assert_almost_equal(r.H_frag[:, 7, 3], H_frag[:, 7, 3], decimal=6)
+        assert_almost_equal(r.H_frag[:, -1, 0], H_frag[:, -1, 0], decimal=6)
+        assert_almost_equal(r.H_frag[2, 4, 4], H_frag[2, 4, 4], decimal=6)
+        assert_almost_equal(r.H_frag[3, :10], H_frag[3, :10], decimal=6)
+        assert_almost_equal(r.H_frag[1:4, 2:5, 6], H_frag[1:4, 2:5, 6], decimal=6)
+        assert_almost_equal(r.H_frag[..., 2], H_frag[..., 2], decimal=6)
+        assert_almost_equal(r.H_frag[1], H_frag[1], decimal=6)
+        for i, j in [(12, 1), (1, 15), (-13, 0)]:
+            with pytest.raises(IndexError):
+                r.H_frag[0, i, j]
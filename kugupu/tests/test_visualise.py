@@ -0,0 +1,96 @@
+import itertools
+import MDAnalysis as mda
+import networkx as nx
+import numpy as np
+import pytest
+from numpy.testing import assert_almost_equal
+
+from kugupu import visualise
+
+
+def _periodic_weight(pos, box, edges):
+    d = mda.lib.distances.distance_array(pos, pos, box=box)
+    return sum(d[i, j] for i, j in edges)
+
+
+@pytest.mark.parametrize('n', [5, visualise.N_NEIGHBOURS + 1])
+def test_spanning_edges(n):
+    box = np.array([10., 12., 14., 90., 90., 90.], dtype=np.float32)
+    rng = np.random.RandomState(42)
+    # some points outside of the primary cell
+    pos = (rng.uniform(-0.5, 1.5, size=(n, 3)) * box[:3]).astype(np.float32)
+
+    # reference minimum spanning tree over all periodic distances
+    d = mda.lib.distances.distance_array(pos, pos, box=box)
+    g = nx.Graph()
+    for i, j in itertools.combinations(range(n), 2):
+        g.add_edge(i, j, weight=d[i, j])
+    ref = [(i, j) for i, j, _ in nx.minimum_spanning_edges(g)]
+
+    edges = list(visualise._spanning_edges(pos, box))
+
+    assert len(edges) == n - 1
+    assert_almost_equal(_periodic_weight(pos, box, edges),
+                        _periodic_weight(pos, box, ref), decimal=4)
+
+
+def test_spanning_edges_triclinic():
+    n = 6
+    box = np.array([10., 10., 10., 90., 60., 90.], dtype=np.float32)
+    rng = np.random.RandomState(42)
+    pos = (rng.uniform(0., 1., size=(n, 3)) * box[:3]).astype(np.float32)
+
+    edges = list(visualise._spanning_edges(pos, box))
+
+    g = nx.Graph(edges)
+    assert len(edges) == n - 1
+    assert g.number_of_nodes() == n
+    assert nx.is_connected(g)
+
+
+@pytest.fixture
+def two_clusters():
+    # two clusters of diatomic fragments, far enough apart that the
+    # neighbour graph is disconnected and a spanning forest is made
+    nper = visualise.N_NEIGHBOURS + 2
+    nfrags = 2 * nper
+    u = mda.Universe.empty(2 * nfrags, n_residues=nfrags,
+                           atom_resindex=np.repeat(np.arange(nfrags), 2),
+                           trajectory=True)
+    u.add_TopologyAttr('bonds', [(2 * i, 2 * i + 1) for i in range(nfrags)])
+    u.dimensions = [100., 100., 100., 90., 90., 90.]
+
+    rng = np.random.RandomState(7)
+    cogs = np.concatenate([rng.uniform(10., 14., size=(nper, 3)),
+                           rng.uniform(60., 64., size=(nper, 3))])
+    # put one fragment of each cluster in a different image
+    cogs[0] += [100., 0., 0.]
+    cogs[-1] -= [0., 0., 100.]
+    pos = np.repeat(cogs, 2, axis=0)
+    pos[1::2, 0] += 0.5
+    u.atoms.positions = pos
+
+    return u, nper
+
+
+def test_gather_network_forest(two_clusters):
+    u, nper = two_clusters
+    frags = u.atoms.fragments
+
+    g = visualise._gather_network(frags)
+
+    assert g.number_of_nodes() == len(frags)
+    assert nx.number_connected_components(g) == 2
+    for cluster in (frags[:nper], frags[nper:]):
+        cogs = np.array([f.center_of_geometry() for f in cluster])
+        span = cogs.max(axis=0) - cogs.min(axis=0)
+        assert (span < 10.0).all()
+
+
+def test_gen_frag_positions(two_clusters):
+    u, _ = two_clusters
+    frags = u.atoms.fragments[::-1]
+
+    ref = np.array([f.center_of_geometry() for f in frags])
+
+    assert_almost_equal(visualise._gen_frag_positions(frags), ref, decimal=5)
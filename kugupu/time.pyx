@@ -20,18 +20,19 @@ Determines time based characteristics of coupling networks
 
 """
 import cython
+from cython cimport floating
 import numpy as np
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def determine_lifetimes(const double[:, :, :] coupling,
+def determine_lifetimes(const floating[:, :, :] coupling,
                         float thresh):
     """Scan a coupling matrix timeseries to extract coupling durations
 
     Parameters
     ----------
-    couplings : float64 array
+    couplings : float32 or float64 array
       coupling values over time, with shape(nframes, nfrags, nfrags)
     thresh : float
       critical value above which a coupling is ON otherwise OFF
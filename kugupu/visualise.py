@@ -18,11 +18,18 @@ import io
 import MDAnalysis as mda
 import networkx as nx
 import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import minimum_spanning_tree
+from scipy.spatial import cKDTree
 import warnings
 
+from .generate_results import _fragment_order
+
 COL_DICT = {'r': [1, 0, 0],
             'g': [0, 1, 0],
             'b': [0, 0, 1]}
+# number of nearest neighbours considered when spanning fragments
+N_NEIGHBOURS = 12
 
 
 def _copy_universe(atomgroup):
@@ -66,33 +73,20 @@ def _copy_universe(atomgroup):
     return u_new, mapping
 
 
-def _move_image(ref_point, atomgroup):
-    """Move atomgroup to closest image to ref_point
+def _gen_frag_positions(fragments):
+    """Center of geometry of each fragment
 
-    Parameters
-    ----------
-    ref_point : coordinate
-      position to move atomgroup close to
-    atomgroup : mda.AtomGroup
-      atomgroup will be translated in place
+    Centers of all fragments are found with one reduceat call
+    over their concatenated positions
 
     Returns
     -------
-    shift : ndarray (3,)
-      the applied shift expressed as multiples of box dimensions
+    centers : numpy array, shape (nfrags, 3)
     """
-    vec = ref_point - atomgroup.center_of_geometry()
-
-    shift = np.rint((ref_point - atomgroup.center_of_geometry()) / atomgroup.dimensions[:3])
-
-    if shift.any():
-        atomgroup.translate(shift * atomgroup.dimensions[:3])
+    atoms, frag_ptr = _fragment_order(list(fragments))
 
-    return shift
-
-
-def _gen_frag_positions(fragments):
-    return np.array([frag.center_of_geometry() for frag in fragments])
+    return (np.add.reduceat(atoms.positions, frag_ptr[:-1], axis=0)
+            / np.diff(frag_ptr)[:, None])
 
 
 def _draw_fragment_centers(view, fragments, color='r'):
@@ -107,22 +101,73 @@ def _draw_fragment_centers(view, fragments, color='r'):
 
 def _draw_fragment_links(view, fragments, links, color='r'):
     """Draw links between fragment centers"""
-    p1, p2 = [], []
+    fragments = list(fragments)
+    pos = _gen_frag_positions(fragments)
+    index = {f: k for k, f in enumerate(fragments)}
+    # fragment indices at either end of each link
+    ends = np.array([(index[i], index[j]) for i, j in links],
+                    dtype=int).reshape(-1, 2)
+    p1 = pos[ends[:, 0]]
+    p2 = pos[ends[:, 1]]
+
+    # check that bond length is sensible...
     boxsize = fragments[0].dimensions[:3].min() / 2.
-    for i, j in links:
-        # check that bond length is sensible...
-        i_pos = i.center_of_geometry()
-        j_pos = j.center_of_geometry()
-        if mda.lib.distances.calc_bonds(i_pos, j_pos) > boxsize:
-            continue
-        p1 += i_pos.tolist()
-        p2 += j_pos.tolist()
+    sensible = np.linalg.norm(p1 - p2, axis=1) <= boxsize
+    p1, p2 = p1[sensible], p2[sensible]
+    nlinks = len(p1)
 
     view.shape.add_buffer("cylinder",
-                          position1=p1,
-                          position2=p2,
-                          color=COL_DICT[color] * len(links),
-                          radius=[0.75] * len(links))
+                          position1=p1.ravel().tolist(),
+                          position2=p2.ravel().tolist(),
+                          color=COL_DICT[color] * nlinks,
+                          radius=[0.75] * nlinks)
+
+
+def _spanning_edges(pos, box):
+    """Minimum spanning tree between points under periodic boundaries
+
+    For orthorhombic boxes only the N_NEIGHBOURS closest points to each
+    point are considered, so the full distance matrix is never built.
+    If the neighbour graph is not connected this returns a minimum
+    spanning forest.  Triclinic boxes use the full distance matrix.
+
+    Parameters
+    ----------
+    pos : numpy array
+      coordinates of each point
+    box : numpy array
+      box dimensions
+
+    Returns
+    -------
+    edges : iterable of (int, int)
+      indices of points joined by the tree
+    """
+    if not np.allclose(box[3:6], 90.0):
+        # periodic kd tree only handles orthorhombic boxes
+        distmat = mda.lib.distances.distance_array(pos, pos, box=box)
+        # make self contribution infinite
+        distmat[np.diag_indices_from(distmat)] = np.inf
+        return ((x, y) for x, y, _ in
+                nx.minimum_spanning_edges(nx.Graph(distmat)))
+    n = len(pos)
+    if n < 2:
+        return zip([], [])
+    boxsize = box[:3].astype(np.float64)
+    # periodic kd tree requires all points inside the box
+    wrapped = pos % boxsize
+    wrapped[wrapped >= boxsize] = 0.0
+
+    k = min(n, N_NEIGHBOURS + 1)
+    dist, idx = cKDTree(wrapped, boxsize=boxsize).query(wrapped, k=k)
+    # first column is each point itself
+    rows = np.repeat(np.arange(n), k - 1)
+    graph = sparse.coo_matrix((dist[:, 1:].ravel(),
+                               (rows, idx[:, 1:].ravel())),
+                              shape=(n, n))
+    tree = minimum_spanning_tree(graph).tocoo()
+
+    return zip(tree.row, tree.col)
 
 
 def _gather_network(frags):
@@ -140,37 +185,39 @@ def _gather_network(frags):
         mda.lib.mdamath.make_whole(f)
     # generate fragment positions
     pos = _gen_frag_positions(frags)
-    distmat = mda.lib.distances.distance_array(
-        pos, pos, box=frags[0].dimensions)
-    # make self contribution infinite
-    distmat[np.diag_indices_from(distmat)] = np.inf
+    box = frags[0].dimensions
 
     # time to make graph
     g = nx.Graph()
     g.add_nodes_from(frags)
-    for x, y, _ in nx.minimum_spanning_edges(nx.Graph(distmat)):
+    for x, y in _spanning_edges(pos, box):
         g.add_edge(frags[x], frags[y])
 
-    box = frags[0].dimensions
     center = box[:3] / 2.
     # find fragment most near the center?
-    center_frag = np.argmin(
-        mda.lib.distances.distance_array(
-            pos,
-            center
-        )
-    )
+    center_frag = int(np.argmin(((pos - center) ** 2).sum(axis=1)))
+    # centers of each fragment, kept up to date as fragments are moved
+    cogs = {id(f): p for f, p in zip(frags, pos)}
     starts = set([frags[center_frag]])
     done = set()
 
     while len(done) < len(frags):
+        if not starts - done:
+            # spanning tree can be a forest, start on the next tree
+            starts.add(next(f for f in frags if f not in done))
         center = list(starts - done)[0]
-        ref_point = center.center_of_geometry()
-        for neb in g[center]:
-            if neb in starts:
-                continue
-            _move_image(ref_point, neb)
-            starts.add(neb)
+        ref_point = cogs[id(center)]
+        nebs = [neb for neb in g[center] if neb not in starts]
+        if nebs:
+            # closest image of all neighbours to center at once
+            neb_cogs = np.array([cogs[id(neb)] for neb in nebs])
+            shifts = np.rint((ref_point - neb_cogs) / box[:3]) * box[:3]
+            for neb, shift in zip(nebs, shifts):
+                if shift.any():
+                    neb.translate(shift)
+                    # rows of pos, so updated in place
+                    cogs[id(neb)] += shift
+            starts.update(nebs)
 
         done.add(center)
 
@@ -7,6 +7,7 @@ from setuptools.extension import Extension
 from Cython.Build import cythonize
 import versioneer
 import os
+import sys
 
 DOCLINES = __doc__.split("\n")
 
@@ -34,6 +35,20 @@ extensions = [
     )
 ]
 
+# Ahead of time compiled numba kernels, optional as
+# kugupu will jit compile these if they're not built
+try:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'devtools'))
+    from aot_kernels import cc
+except ImportError:
+    aot_extensions = []
+else:
+    aot_ext = cc.distutils_extension()
+    aot_ext.name = 'kugupu._kugupu_kernels'
+    aot_extensions = [aot_ext]
+finally:
+    sys.path.pop(0)
+
 setup(
     # Self-descriptive entries which should always be present
     name='kugupu',
@@ -49,7 +64,7 @@ setup(
     scripts=['bin/kugupu'],
     ext_modules = cythonize(extensions,
                             compiler_directives={'linetrace': True},
-    ),
+    ) + aot_extensions,
     # Optional include package data to ship with your package
     # Comment out this line to prevent the files from being packaged with your software
     # Extend/modify the list to include/exclude other items as need be